@@ -1,4 +1,5 @@
-from fastapi import FastAPI, APIRouter, WebSocket, WebSocketDisconnect, HTTPException
+from fastapi import FastAPI, APIRouter, WebSocket, WebSocketDisconnect, HTTPException, Request
+from fastapi.responses import StreamingResponse
 from dotenv import load_dotenv
 from starlette.middleware.cors import CORSMiddleware
 from motor.motor_asyncio import AsyncIOMotorClient
@@ -6,12 +7,23 @@ import os
 import logging
 from pathlib import Path
 from pydantic import BaseModel, Field
-from typing import List, Optional
+from typing import AsyncIterator, List, Optional
 import uuid
-from datetime import datetime
+from datetime import datetime, timedelta
 import asyncio
 import subprocess
 import json
+import re
+import csv
+import io
+import zlib
+import math
+import time
+from collections import OrderedDict, deque
+from pymongo import UpdateOne
+import requests
+import numpy as np
+import pandas as pd
 
 
 ROOT_DIR = Path(__file__).parent
@@ -54,6 +66,9 @@ class ScanSession(BaseModel):
     probe: str
     status: str = "pending"  # pending, running, completed, failed
     output: str = ""
+    client_id: Optional[str] = None
+    ollama_host: Optional[str] = None
+    results: List[dict] = Field(default_factory=list)
     created_at: datetime = Field(default_factory=datetime.utcnow)
     completed_at: Optional[datetime] = None
 
@@ -92,6 +107,594 @@ class ConnectionManager:
 
 manager = ConnectionManager()
 
+# Ollama endpoint pool
+def _normalize_model_name(name: str) -> str:
+    """Ollama treats a bare model name as the :latest tag"""
+    return name if ":" in name else f"{name}:latest"
+
+def _format_size(num_bytes: int) -> str:
+    """Render a byte count the way `ollama list` does"""
+    size = float(num_bytes)
+    for unit in ["B", "KB", "MB", "GB"]:
+        if size < 1000:
+            return f"{size:.0f} {unit}" if unit == "B" else f"{size:.1f} {unit}"
+        size /= 1000
+    return f"{size:.1f} TB"
+
+class OllamaEndpoint:
+    def __init__(self, host: str):
+        if "://" not in host:
+            host = f"http://{host}"
+        self.host = host.rstrip("/")
+        self.healthy: bool = False
+        self.in_flight: int = 0
+        self.models: dict = {}  # normalized name -> /api/tags entry
+        self.resident: set = set()  # normalized names loaded in memory
+        self.last_checked: Optional[datetime] = None
+        self.error: Optional[str] = None
+
+    def has_model(self, model_name: str) -> bool:
+        name = _normalize_model_name(model_name)
+        return name in self.models or name in self.resident
+
+    def to_dict(self) -> dict:
+        return {
+            "host": self.host,
+            "healthy": self.healthy,
+            "in_flight": self.in_flight,
+            "models": sorted(self.models.keys()),
+            "resident": sorted(self.resident),
+            "last_checked": self.last_checked,
+            "error": self.error
+        }
+
+class OllamaPool:
+    def __init__(self, hosts: List[str], timeout: float = 3.0):
+        self.endpoints: List[OllamaEndpoint] = [OllamaEndpoint(host) for host in hosts]
+        self.timeout = timeout
+
+    def _fetch(self, url: str) -> dict:
+        response = requests.get(url, timeout=self.timeout)
+        response.raise_for_status()
+        return response.json()
+
+    async def check_endpoint(self, endpoint: OllamaEndpoint):
+        """Refresh health and model inventory of a single endpoint"""
+        try:
+            tags = await asyncio.to_thread(self._fetch, f"{endpoint.host}/api/tags")
+            endpoint.models = {
+                _normalize_model_name(model["name"]): model
+                for model in tags.get("models", [])
+            }
+            try:
+                running = await asyncio.to_thread(self._fetch, f"{endpoint.host}/api/ps")
+                endpoint.resident = {
+                    _normalize_model_name(model["name"])
+                    for model in running.get("models", [])
+                }
+            except Exception:
+                # Older Ollama releases have no /api/ps
+                endpoint.resident = set()
+            endpoint.healthy = True
+            endpoint.error = None
+        except Exception as e:
+            endpoint.healthy = False
+            endpoint.error = str(e)
+        endpoint.last_checked = datetime.utcnow()
+
+    async def refresh(self):
+        await asyncio.gather(*(self.check_endpoint(endpoint) for endpoint in self.endpoints))
+
+    async def ensure_checked(self):
+        """Refresh only when some endpoint has never been checked"""
+        if any(endpoint.last_checked is None for endpoint in self.endpoints):
+            await self.refresh()
+
+    def acquire(self, model_name: str) -> OllamaEndpoint:
+        """Reserve the least-loaded healthy endpoint serving the model"""
+        healthy = [endpoint for endpoint in self.endpoints if endpoint.healthy]
+        if not healthy:
+            raise RuntimeError("No healthy Ollama endpoint available")
+
+        name = _normalize_model_name(model_name)
+        candidates = [endpoint for endpoint in healthy if endpoint.has_model(name)]
+        if not candidates:
+            raise RuntimeError(f"No healthy endpoint serves {model_name}")
+
+        endpoint = min(
+            candidates,
+            key=lambda e: (e.in_flight, name not in e.resident)
+        )
+        endpoint.in_flight += 1
+        return endpoint
+
+    def release(self, endpoint: OllamaEndpoint):
+        endpoint.in_flight = max(0, endpoint.in_flight - 1)
+
+    def inventory(self) -> List[dict]:
+        """Merge model listings across healthy endpoints"""
+        merged: dict = {}
+        for endpoint in self.endpoints:
+            if not endpoint.healthy:
+                continue
+            for name, model in endpoint.models.items():
+                if name not in merged:
+                    merged[name] = {
+                        "name": name,
+                        "tag": model.get("digest", "")[:12] or "latest",
+                        "size": _format_size(model["size"]) if "size" in model else "unknown",
+                        "modified": model.get("modified_at", "unknown"),
+                        "endpoints": []
+                    }
+                merged[name]["endpoints"].append(endpoint.host)
+        return [merged[name] for name in sorted(merged)]
+
+ollama_pool = OllamaPool(
+    [host.strip() for host in os.environ.get("OLLAMA_HOSTS", "http://localhost:11434").split(",") if host.strip()],
+    timeout=float(os.environ.get("OLLAMA_TIMEOUT", "3"))
+)
+OLLAMA_HEALTH_INTERVAL = float(os.environ.get("OLLAMA_HEALTH_INTERVAL", "15"))
+
+async def ollama_health_loop():
+    """Periodically refresh the Ollama pool"""
+    while True:
+        try:
+            await ollama_pool.refresh()
+        except Exception as e:
+            logger.error(f"Ollama health check failed: {e}")
+        await asyncio.sleep(OLLAMA_HEALTH_INTERVAL)
+
+# Results analytics
+ROLLUP_KEYS = ["model_name", "probe", "detector"]
+ANSI_ESCAPE = re.compile(r"\x1b\[[0-9;]*m")
+# e.g. "dan.Dan_11_0    dan.DAN: FAIL  ok on    0/   5   (failure rate: 100.00%)"
+GARAK_RESULT_LINE = re.compile(r"^\s*(\S+)\s+(\S+):\s+(PASS|FAIL)\s+ok on\s+(\d+)\s*/\s*(\d+)")
+
+def parse_garak_results(output: str) -> List[dict]:
+    """Extract per-detector pass counts from garak's summary lines"""
+    results = []
+    for line in output.split("\n"):
+        match = GARAK_RESULT_LINE.match(ANSI_ESCAPE.sub("", line))
+        if match:
+            probe, detector, _, passed, total = match.groups()
+            results.append({
+                "probe": probe,
+                "detector": detector,
+                "passed": int(passed),
+                "total": int(total)
+            })
+    return results
+
+ANALYTICS_TREND_DAYS = int(os.environ.get("ANALYTICS_TREND_DAYS", "30"))
+ANALYTICS_MAX_LIMIT = int(os.environ.get("ANALYTICS_MAX_LIMIT", "5000"))
+ANALYTICS_BACKFILL_BATCH = int(os.environ.get("ANALYTICS_BACKFILL_BATCH", "5000"))
+# Guards against concurrent backfills; set before the first await
+analytics_backfill_running: bool = False
+# Set once the staging collections are ready to receive live updates
+analytics_backfill_cutoff: Optional[datetime] = None
+
+async def create_analytics_indexes(rollups, trends):
+    await rollups.create_index([(key, 1) for key in ROLLUP_KEYS], unique=True)
+    await trends.create_index([(key, 1) for key in ROLLUP_KEYS + ["day"]], unique=True)
+    await trends.create_index([("day", 1)])
+
+def _counts(record: dict) -> dict:
+    return {"passed": record["passed"], "total": record["total"], "scans": record["scans"]}
+
+def _rollup_update(key: dict, counts: dict, updated_at: datetime) -> UpdateOne:
+    return UpdateOne(key, {"$inc": counts, "$max": {"updated_at": updated_at}}, upsert=True)
+
+def _trend_update(key: dict, day: str, counts: dict) -> UpdateOne:
+    return UpdateOne({**key, "day": day}, {"$inc": counts}, upsert=True)
+
+async def update_analytics(session: ScanSession, results: List[dict], completed_at: datetime):
+    """Fold a finished scan's results into the rollup collections"""
+    if not results:
+        return
+    day = completed_at.strftime("%Y-%m-%d")
+    rollup_ops, trend_ops = [], []
+    for result in results:
+        key = {
+            "model_name": session.model_name,
+            "probe": result["probe"],
+            "detector": result["detector"]
+        }
+        counts = _counts({**result, "scans": 1})
+        rollup_ops.append(_rollup_update(key, counts, completed_at))
+        trend_ops.append(_trend_update(key, day, counts))
+
+    targets = [(db.analytics_rollups, db.analytics_trends)]
+    if analytics_backfill_cutoff is not None and completed_at >= analytics_backfill_cutoff:
+        # The running backfill only reads history before its cutoff
+        targets.append((db.analytics_rollups_staging, db.analytics_trends_staging))
+    for rollups, trends in targets:
+        await rollups.bulk_write(rollup_ops, ordered=False)
+        await trends.bulk_write(trend_ops, ordered=False)
+
+def aggregate_result_rows(rows: List[dict]):
+    """Sum per-session result rows into rollup and trend records
+
+    Rows of one session must not be split across calls, since scans are
+    counted as distinct sessions within each call.
+    """
+    frame = pd.DataFrame(rows)
+    frame["day"] = pd.to_datetime(frame["completed_at"]).dt.strftime("%Y-%m-%d")
+    aggregations = {
+        "passed": ("passed", "sum"),
+        "total": ("total", "sum"),
+        "scans": ("session_id", "nunique")
+    }
+    rollups = frame.groupby(ROLLUP_KEYS, as_index=False).agg(
+        updated_at=("completed_at", "max"), **aggregations
+    )
+    trends = frame.groupby(ROLLUP_KEYS + ["day"], as_index=False).agg(**aggregations)
+    return rollups.astype(object).to_dict("records"), trends.astype(object).to_dict("records")
+
+async def _backfill_batch(rows: List[dict]):
+    """Aggregate a batch off the event loop and add it to the staging rollups"""
+    rollup_records, trend_records = await asyncio.to_thread(aggregate_result_rows, rows)
+    # Upsert rather than insert so scans mirrored in meanwhile merge cleanly
+    await db.analytics_rollups_staging.bulk_write([
+        _rollup_update({key: record[key] for key in ROLLUP_KEYS}, _counts(record), record["updated_at"])
+        for record in rollup_records
+    ], ordered=False)
+    await db.analytics_trends_staging.bulk_write([
+        _trend_update({key: record[key] for key in ROLLUP_KEYS}, record["day"], _counts(record))
+        for record in trend_records
+    ], ordered=False)
+
+def _with_pass_rate(records: List[dict]) -> List[dict]:
+    if not records:
+        return records
+    passed = np.array([record["passed"] for record in records], dtype=float)
+    total = np.array([record["total"] for record in records], dtype=float)
+    rates = np.divide(passed, total, out=np.full_like(passed, np.nan), where=total > 0)
+    for record, rate in zip(records, rates):
+        record["pass_rate"] = None if np.isnan(rate) else round(float(rate), 4)
+    return records
+
+# Bulk export
+EXPORT_BATCH_SIZE = int(os.environ.get("EXPORT_BATCH_SIZE", "500"))
+EXPORT_CHUNK_SIZE = 64 * 1024
+EXPORT_FORMATS = {"ndjson": "application/x-ndjson", "csv": "text/csv"}
+SESSION_EXPORT_FIELDS = [
+    "id", "model_name", "environment", "tool", "probe", "status",
+    "client_id", "ollama_host", "created_at", "completed_at", "output"
+]
+RESULT_EXPORT_FIELDS = [
+    "session_id", "model_name", "environment", "client_id", "session_probe", "probe",
+    "detector", "passed", "total", "completed_at"
+]
+
+def _export_value(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    return value
+
+def _export_query(model: Optional[str], probe: Optional[str],
+                  since: Optional[datetime], until: Optional[datetime]) -> dict:
+    query = {}
+    if model:
+        query["model_name"] = model
+    if probe:
+        query["probe"] = probe
+    if since or until:
+        query["created_at"] = {}
+        if since:
+            query["created_at"]["$gte"] = since
+        if until:
+            query["created_at"]["$lt"] = until
+    return query
+
+async def _encode_rows(rows: AsyncIterator[dict], fields: List[str], fmt: str) -> AsyncIterator[bytes]:
+    """Serialize rows as NDJSON or CSV in chunks of about EXPORT_CHUNK_SIZE"""
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, fieldnames=fields, extrasaction="ignore")
+    if fmt == "csv":
+        writer.writeheader()
+    async for row in rows:
+        row = {field: _export_value(row.get(field)) for field in fields}
+        if fmt == "csv":
+            writer.writerow(row)
+        else:
+            buffer.write(json.dumps(row, default=str) + "\n")
+        if buffer.tell() >= EXPORT_CHUNK_SIZE:
+            yield buffer.getvalue().encode()
+            buffer.seek(0)
+            buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue().encode()
+
+async def _result_rows(sessions: AsyncIterator[dict], probe: Optional[str]) -> AsyncIterator[dict]:
+    """Flatten sessions into one row per probe and detector result"""
+    async for session in sessions:
+        results = session.get("results") or parse_garak_results(session.get("output") or "")
+        for result in results:
+            if probe and result["probe"] != probe:
+                continue
+            yield {
+                "session_id": session["id"],
+                "model_name": session["model_name"],
+                "environment": session.get("environment"),
+                "client_id": session.get("client_id"),
+                "session_probe": session.get("probe"),
+                "completed_at": session.get("completed_at"),
+                **result
+            }
+
+async def _gzip_chunks(chunks: AsyncIterator[bytes]) -> AsyncIterator[bytes]:
+    compressor = zlib.compressobj(wbits=31)  # gzip container
+    async for chunk in chunks:
+        compressed = compressor.compress(chunk)
+        if compressed:
+            yield compressed
+    yield compressor.flush()
+
+def _export_response(rows: AsyncIterator[dict], fields: List[str], fmt: str,
+                     compress: bool, name: str) -> StreamingResponse:
+    if fmt not in EXPORT_FORMATS:
+        raise HTTPException(status_code=400, detail=f"Unsupported format: {fmt}")
+    body = _encode_rows(rows, fields, fmt)
+    filename = f"{name}.{fmt}"
+    media_type = EXPORT_FORMATS[fmt]
+    if compress:
+        body = _gzip_chunks(body)
+        filename += ".gz"
+        media_type = "application/gzip"
+    headers = {"Content-Disposition": f'attachment; filename="{filename}"'}
+    return StreamingResponse(body, media_type=media_type, headers=headers)
+
+# Scan admission control
+class QuotaExceeded(Exception):
+    def __init__(self, reason: str, retry_after: int):
+        super().__init__(reason)
+        self.retry_after = retry_after
+
+class ClientQuota(BaseModel):
+    max_concurrent: int = 2
+    max_queued: int = 10
+    rate_per_minute: float = 30
+    weight: float = Field(default=1.0, gt=0)
+
+class ClientUsage:
+    def __init__(self, client_id: str, quota: ClientQuota):
+        self.client_id = client_id
+        self.quota = quota
+        self.running: int = 0
+        self.waiting: deque = deque()
+        self.tokens: float = quota.rate_per_minute
+        self.last_refill: float = time.monotonic()
+        self.vtime: float = 0.0
+
+    @property
+    def idle(self) -> bool:
+        """No scans in flight and a full bucket, so the entry carries no state"""
+        self.refill()
+        return not self.running and not self.waiting and self.tokens >= self.quota.rate_per_minute
+
+    def refill(self):
+        now = time.monotonic()
+        rate = self.quota.rate_per_minute / 60
+        self.tokens = min(self.quota.rate_per_minute, self.tokens + (now - self.last_refill) * rate)
+        self.last_refill = now
+
+class ClientStats:
+    """Usage counters kept after a client's scheduling state is pruned"""
+
+    def __init__(self):
+        self.submitted: int = 0
+        self.rejected: int = 0
+        self.completed: int = 0
+        self.last_seen: Optional[datetime] = None
+
+class ScanScheduler:
+    """Weighted fair-share allocation of scan slots across clients"""
+
+    def __init__(self, capacity: int, max_queued: int, max_clients: int,
+                 default_quota: ClientQuota, quotas: dict, retry_after: int):
+        self.capacity = capacity
+        self.max_queued = max_queued
+        self.max_clients = max_clients
+        self.default_quota = default_quota
+        self.quotas = quotas
+        self.retry_after = retry_after
+        self.clients: dict = {}
+        self.stats: OrderedDict = OrderedDict()  # least recently seen first
+        self.vclock: float = 0.0
+
+    def usage(self, client_id: str) -> ClientUsage:
+        if client_id not in self.clients:
+            quota = self.quotas.get(client_id, self.default_quota)
+            self.clients[client_id] = ClientUsage(client_id, quota)
+        return self.clients[client_id]
+
+    def client_stats(self, client_id: str) -> ClientStats:
+        """Counters for the client, evicting the least recently seen beyond max_clients"""
+        if client_id in self.stats:
+            self.stats.move_to_end(client_id)
+        else:
+            self.stats[client_id] = ClientStats()
+            if len(self.stats) > self.max_clients:
+                self.stats.popitem(last=False)
+        return self.stats[client_id]
+
+    @property
+    def running(self) -> int:
+        return sum(usage.running for usage in self.clients.values())
+
+    @property
+    def queued(self) -> int:
+        return sum(len(usage.waiting) for usage in self.clients.values())
+
+    def _prune(self):
+        """Forget clients that have nothing in flight and a full bucket"""
+        for client_id in [client_id for client_id, usage in self.clients.items() if usage.idle]:
+            del self.clients[client_id]
+
+    def _reserve(self, client_id: str) -> ClientUsage:
+        """Check global and per-client limits and take a rate token"""
+        self._prune()
+        if self.queued >= self.max_queued:
+            raise QuotaExceeded("Too many scans are queued", self.retry_after)
+        if client_id not in self.clients and len(self.clients) >= self.max_clients:
+            raise QuotaExceeded("Too many clients have scans in flight", self.retry_after)
+
+        usage = self.usage(client_id)
+        usage.refill()
+        if len(usage.waiting) >= usage.quota.max_queued:
+            raise QuotaExceeded(f"Client {client_id} has too many queued scans", self.retry_after)
+        if usage.tokens < 1:
+            rate = usage.quota.rate_per_minute / 60
+            retry_after = math.ceil((1 - usage.tokens) / rate) if rate > 0 else self.retry_after
+            raise QuotaExceeded(f"Client {client_id} exceeded its scan rate", retry_after)
+        usage.tokens -= 1
+        return usage
+
+    def admit(self, client_id: str) -> asyncio.Future:
+        """Queue a scan for the client or raise QuotaExceeded"""
+        stats = self.client_stats(client_id)
+        stats.last_seen = datetime.utcnow()
+        try:
+            usage = self._reserve(client_id)
+        except QuotaExceeded:
+            stats.rejected += 1
+            raise
+        stats.submitted += 1
+        if not usage.waiting and not usage.running:
+            # Idle clients do not bank credit while away
+            usage.vtime = max(usage.vtime, self.vclock)
+        ticket = asyncio.get_running_loop().create_future()
+        usage.waiting.append(ticket)
+        self._dispatch()
+        return ticket
+
+    def withdraw(self, client_id: str, ticket: asyncio.Future):
+        """Give back a ticket that will never run"""
+        usage = self.usage(client_id)
+        if ticket in usage.waiting:
+            usage.waiting.remove(ticket)
+            ticket.cancel()
+        elif ticket.done() and not ticket.cancelled():
+            usage.running = max(0, usage.running - 1)
+        self._dispatch()
+
+    def release(self, client_id: str):
+        usage = self.usage(client_id)
+        usage.running = max(0, usage.running - 1)
+        self.client_stats(client_id).completed += 1
+        self._dispatch()
+
+    def report(self) -> List[dict]:
+        """Per-client usage, most recently seen first"""
+        client_ids = list(reversed(self.stats)) + [c for c in self.clients if c not in self.stats]
+        report = []
+        for client_id in client_ids:
+            usage = self.clients.get(client_id)
+            if usage:
+                usage.refill()
+            quota = usage.quota if usage else self.quotas.get(client_id, self.default_quota)
+            stats = self.stats.get(client_id, ClientStats())
+            report.append({
+                "client_id": client_id,
+                "running": usage.running if usage else 0,
+                "queued": len(usage.waiting) if usage else 0,
+                "submitted": stats.submitted,
+                "rejected": stats.rejected,
+                "completed": stats.completed,
+                "last_seen": stats.last_seen,
+                "tokens": round(usage.tokens if usage else quota.rate_per_minute, 2),
+                "quota": quota.dict()
+            })
+        return report
+
+    def _dispatch(self):
+        while self.running < self.capacity:
+            eligible = [
+                usage for usage in self.clients.values()
+                if usage.waiting and usage.running < usage.quota.max_concurrent
+            ]
+            if not eligible:
+                return
+            usage = min(eligible, key=lambda u: (u.vtime, u.running / u.quota.weight))
+            ticket = usage.waiting.popleft()
+            if ticket.done():
+                continue
+            self.vclock = usage.vtime
+            usage.vtime += 1 / usage.quota.weight
+            usage.running += 1
+            ticket.set_result(None)
+
+def _load_client_quotas(default_quota: ClientQuota) -> dict:
+    """Parse SCAN_CLIENT_QUOTAS, filling unset fields from the default quota"""
+    raw = json.loads(os.environ.get("SCAN_CLIENT_QUOTAS", "{}"))
+    return {
+        client_id: ClientQuota(**{**default_quota.dict(), **quota})
+        for client_id, quota in raw.items()
+    }
+
+def _load_api_keys() -> dict:
+    """Parse SCAN_API_KEYS as comma separated key:client_id pairs"""
+    api_keys = {}
+    for entry in os.environ.get("SCAN_API_KEYS", "").split(","):
+        if ":" in entry:
+            key, client_id = entry.split(":", 1)
+            api_keys[key.strip()] = client_id.strip()
+    return api_keys
+
+default_client_quota = ClientQuota(
+    max_concurrent=int(os.environ.get("SCAN_DEFAULT_MAX_CONCURRENT", "2")),
+    max_queued=int(os.environ.get("SCAN_DEFAULT_MAX_QUEUED", "10")),
+    rate_per_minute=float(os.environ.get("SCAN_DEFAULT_RATE_PER_MINUTE", "30"))
+)
+scan_scheduler = ScanScheduler(
+    capacity=int(os.environ.get("SCAN_MAX_CONCURRENT", "4")),
+    max_queued=int(os.environ.get("SCAN_MAX_QUEUED", "100")),
+    max_clients=int(os.environ.get("SCAN_MAX_CLIENTS", "1000")),
+    default_quota=default_client_quota,
+    quotas=_load_client_quotas(default_client_quota),
+    retry_after=int(os.environ.get("SCAN_RETRY_AFTER", "30"))
+)
+SCAN_API_KEYS = _load_api_keys()
+# A valid X-API-Key is mandatory once keys are configured, unless disabled
+SCAN_REQUIRE_API_KEY = os.environ.get("SCAN_REQUIRE_API_KEY", "true" if SCAN_API_KEYS else "false").lower() == "true"
+# X-Client-Id is self-declared; only honor it when every caller is trusted
+SCAN_TRUST_CLIENT_HEADERS = os.environ.get("SCAN_TRUST_CLIENT_HEADERS", "false").lower() == "true"
+# Number of reverse proxies in front of the API that append to X-Forwarded-For
+SCAN_TRUSTED_PROXIES = int(os.environ.get("SCAN_TRUSTED_PROXIES", "0"))
+ADMIN_API_KEY = os.environ.get("ADMIN_API_KEY")
+
+def require_admin(request: Request):
+    """Admin routes stay disabled until ADMIN_API_KEY is configured"""
+    if not ADMIN_API_KEY:
+        raise HTTPException(status_code=403, detail="Admin API disabled; set ADMIN_API_KEY")
+    if request.headers.get("X-Admin-Key") != ADMIN_API_KEY:
+        raise HTTPException(status_code=403, detail="Admin key required")
+
+def identify_client(request: Request) -> str:
+    """Resolve the submitting client from its API key, client id or address"""
+    api_key = request.headers.get("X-API-Key")
+    if api_key:
+        if api_key not in SCAN_API_KEYS:
+            raise HTTPException(status_code=401, detail="Invalid API key")
+        return SCAN_API_KEYS[api_key]
+    if SCAN_REQUIRE_API_KEY:
+        raise HTTPException(status_code=401, detail="API key required")
+
+    if SCAN_TRUST_CLIENT_HEADERS:
+        client_id = request.headers.get("X-Client-Id")
+        if client_id:
+            return client_id
+    if SCAN_TRUSTED_PROXIES:
+        # Entries left of those our proxies appended are client-controlled
+        forwarded_for = [
+            address.strip()
+            for address in request.headers.get("X-Forwarded-For", "").split(",")
+            if address.strip()
+        ]
+        if len(forwarded_for) >= SCAN_TRUSTED_PROXIES:
+            return forwarded_for[-SCAN_TRUSTED_PROXIES]
+    return request.client.host if request.client else "anonymous"
+
 # Add your routes to the router instead of directly to app
 @api_router.get("/")
 async def root():
@@ -112,35 +715,21 @@ async def get_status_checks():
 # AI WebUI Endpoints
 @api_router.get("/models")
 async def get_models():
-    """Get available Ollama models"""
+    """Get available Ollama models merged across the endpoint pool"""
     try:
-        result = subprocess.run(
-            ["ollama", "list"],
-            capture_output=True,
-            text=True,
-            check=True
-        )
-        
-        models = []
-        lines = result.stdout.strip().split('\n')[1:]  # Skip header
-        
-        for line in lines:
-            if line.strip():
-                parts = line.split()
-                if len(parts) >= 3:
-                    models.append({
-                        "name": parts[0],
-                        "tag": parts[1] if len(parts) > 1 else "latest",
-                        "size": parts[2] if len(parts) > 2 else "unknown",
-                        "modified": " ".join(parts[3:]) if len(parts) > 3 else "unknown"
-                    })
-        
+        await ollama_pool.ensure_checked()
+        models = ollama_pool.inventory()
+        if not any(endpoint.healthy for endpoint in ollama_pool.endpoints):
+            return {"models": [], "error": "Ollama not available"}
         return {"models": models}
-    except subprocess.CalledProcessError:
-        return {"models": [], "error": "Ollama not available"}
     except Exception as e:
         return {"models": [], "error": str(e)}
 
+@api_router.get("/ollama/endpoints")
+async def get_ollama_endpoints():
+    """Get health and load of each Ollama endpoint"""
+    return {"endpoints": [endpoint.to_dict() for endpoint in ollama_pool.endpoints]}
+
 @api_router.get("/environments")
 async def get_environments():
     """Get available conda environments"""
@@ -197,8 +786,18 @@ async def get_garak_probes():
     return {"probes": probes}
 
 @api_router.post("/scan/start")
-async def start_scan(scan_request: ScanRequest):
+async def start_scan(scan_request: ScanRequest, request: Request):
     """Start a vulnerability scan"""
+    client_id = identify_client(request)
+    try:
+        ticket = scan_scheduler.admit(client_id)
+    except QuotaExceeded as e:
+        raise HTTPException(
+            status_code=429,
+            detail=str(e),
+            headers={"Retry-After": str(e.retry_after)}
+        )
+
     try:
         # Create scan session
         session = ScanSession(
@@ -206,20 +805,34 @@ async def start_scan(scan_request: ScanRequest):
             environment=scan_request.environment,
             tool=scan_request.tool,
             probe=scan_request.probe,
+            client_id=client_id,
             status="pending"
         )
         
         # Save session to database
         await db.scan_sessions.insert_one(session.dict())
         
-        # Start scan asynchronously
-        asyncio.create_task(run_scan(session))
+        # Start scan asynchronously once the scheduler grants a slot
+        asyncio.create_task(run_scan(session, ticket))
         
-        return {"session_id": session.id, "status": "started"}
+        return {"session_id": session.id, "status": "started" if ticket.done() else "queued"}
         
     except Exception as e:
+        scan_scheduler.withdraw(client_id, ticket)
         raise HTTPException(status_code=500, detail=str(e))
 
+@api_router.get("/admin/clients")
+async def get_client_usage(request: Request):
+    """Get per-client scan usage and quotas"""
+    require_admin(request)
+    return {
+        "capacity": scan_scheduler.capacity,
+        "running": scan_scheduler.running,
+        "queued": scan_scheduler.queued,
+        "max_queued": scan_scheduler.max_queued,
+        "clients": scan_scheduler.report()
+    }
+
 @api_router.get("/scan/{session_id}")
 async def get_scan_status(session_id: str):
     """Get scan status and output"""
@@ -237,8 +850,152 @@ async def get_scan_status(session_id: str):
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
-async def run_scan(session: ScanSession):
+@api_router.get("/analytics")
+async def get_analytics(model: Optional[str] = None, probe: Optional[str] = None, detector: Optional[str] = None,
+                        since: Optional[str] = None, until: Optional[str] = None, limit: int = 1000):
+    """Get precomputed pass rates per model, probe and detector"""
+    query = {}
+    if model:
+        query["model_name"] = model
+    if probe:
+        query["probe"] = probe
+    if detector:
+        query["detector"] = detector
+    limit = min(max(limit, 1), ANALYTICS_MAX_LIMIT)
+
+    # Trend days are stored as YYYY-MM-DD, so string comparison orders them
+    try:
+        until = datetime.strptime(until, "%Y-%m-%d") if until else datetime.utcnow()
+        since = datetime.strptime(since, "%Y-%m-%d") if since else until - timedelta(days=ANALYTICS_TREND_DAYS)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="since and until must be YYYY-MM-DD dates")
+    since, until = since.strftime("%Y-%m-%d"), until.strftime("%Y-%m-%d")
+    trend_query = {**query, "day": {"$gte": since, "$lte": until}}
+
+    rollups = await db.analytics_rollups.find(query, {"_id": 0}).sort(
+        [("model_name", 1), ("probe", 1), ("detector", 1)]
+    ).limit(limit).to_list(None)
+    trends = await db.analytics_trends.find(trend_query, {"_id": 0}).sort(
+        [("day", 1), ("model_name", 1), ("probe", 1), ("detector", 1)]
+    ).limit(limit).to_list(None)
+
+    return {
+        "since": since,
+        "until": until,
+        "rollups": _with_pass_rate(rollups),
+        "trends": _with_pass_rate(trends)
+    }
+
+@api_router.post("/analytics/backfill")
+async def backfill_analytics(request: Request):
+    """Rebuild the analytics rollups from the full scan history
+
+    The rebuild goes into staging collections that are renamed over the
+    live ones, so readers never see a partial rollup. Scans finishing
+    meanwhile are written to both the live and the staging collections.
+    """
+    global analytics_backfill_running, analytics_backfill_cutoff
+    require_admin(request)
+    if analytics_backfill_running:
+        raise HTTPException(status_code=409, detail="Analytics backfill already running")
+    analytics_backfill_running = True
+
+    try:
+        await db.analytics_rollups_staging.drop()
+        await db.analytics_trends_staging.drop()
+        await create_analytics_indexes(db.analytics_rollups_staging, db.analytics_trends_staging)
+        analytics_backfill_cutoff = datetime.utcnow()
+
+        rows, sessions = [], 0
+        cursor = db.scan_sessions.find(
+            {
+                "status": {"$in": ["completed", "failed"]},
+                "completed_at": {"$lt": analytics_backfill_cutoff}
+            },
+            {"_id": 0, "id": 1, "model_name": 1, "output": 1, "results": 1, "completed_at": 1}
+        )
+        async for session in cursor:
+            results = session.get("results") or parse_garak_results(session.get("output") or "")
+            if not results:
+                continue
+            sessions += 1
+            for result in results:
+                rows.append({
+                    "session_id": session["id"],
+                    "model_name": session["model_name"],
+                    "completed_at": session["completed_at"],
+                    **result
+                })
+            # Flush between sessions so no session spans two batches
+            if len(rows) >= ANALYTICS_BACKFILL_BATCH:
+                await _backfill_batch(rows)
+                rows = []
+        if rows:
+            await _backfill_batch(rows)
+
+        await db.analytics_rollups_staging.rename("analytics_rollups", dropTarget=True)
+        await db.analytics_trends_staging.rename("analytics_trends", dropTarget=True)
+    finally:
+        analytics_backfill_cutoff = None
+        analytics_backfill_running = False
+
+    return {
+        "sessions": sessions,
+        "rollups": await db.analytics_rollups.count_documents({}),
+        "trends": await db.analytics_trends.count_documents({})
+    }
+
+@api_router.get("/export/sessions")
+async def export_sessions(format: str = "ndjson", model: Optional[str] = None, probe: Optional[str] = None,
+                          since: Optional[datetime] = None, until: Optional[datetime] = None,
+                          gzip: bool = False):
+    """Stream scan sessions as NDJSON or CSV"""
+    query = _export_query(model, probe, since, until)
+    cursor = db.scan_sessions.find(query, {"_id": 0}).sort("created_at", 1).batch_size(EXPORT_BATCH_SIZE)
+    return _export_response(cursor, SESSION_EXPORT_FIELDS, format, gzip, "scan_sessions")
+
+@api_router.get("/export/results")
+async def export_results(format: str = "ndjson", model: Optional[str] = None, probe: Optional[str] = None,
+                         since: Optional[datetime] = None, until: Optional[datetime] = None,
+                         gzip: bool = False):
+    """Stream per-detector scan results as NDJSON or CSV"""
+    query = _export_query(model, None, since, until)
+    if probe:
+        # Sessions from before results were stored are filtered after parsing
+        query["$or"] = [{"results.probe": probe}, {"results.0": {"$exists": False}}]
+    cursor = db.scan_sessions.aggregate([
+        {"$match": query},
+        {"$sort": {"created_at": 1}},
+        {"$project": {
+            "_id": 0,
+            "id": 1,
+            "model_name": 1,
+            "environment": 1,
+            "client_id": 1,
+            "probe": 1,
+            "completed_at": 1,
+            "results": 1,
+            # Only ship the raw output when there are no parsed results
+            "output": {"$cond": [
+                {"$gt": [{"$size": {"$ifNull": ["$results", []]}}, 0]},
+                "$$REMOVE",
+                "$output"
+            ]}
+        }}
+    ], batchSize=EXPORT_BATCH_SIZE)
+
+    return _export_response(_result_rows(cursor, probe), RESULT_EXPORT_FIELDS, format, gzip, "scan_results")
+
+async def run_scan(session: ScanSession, ticket: asyncio.Future):
     """Run the actual vulnerability scan"""
+    endpoint = None
+    try:
+        # Wait for a fair-share scan slot
+        await ticket
+    except asyncio.CancelledError:
+        scan_scheduler.withdraw(session.client_id, ticket)
+        raise
+
     try:
         # Update status to running
         await db.scan_sessions.update_one(
@@ -254,11 +1011,20 @@ async def run_scan(session: ScanSession):
         
         # Build command based on tool
         if session.tool == "garak":
+            if not any(endpoint.healthy for endpoint in ollama_pool.endpoints):
+                await ollama_pool.refresh()
+            endpoint = ollama_pool.acquire(session.model_name)
+            await db.scan_sessions.update_one(
+                {"id": session.id},
+                {"$set": {"ollama_host": endpoint.host}}
+            )
+            generator_options = {"ollama": {"OllamaGenerator": {"host": endpoint.host}}}
             command = [
                 "conda", "run", "-n", session.environment,
                 "python", "-m", "garak",
                 "--model_type", "ollama",
                 "--model_name", session.model_name,
+                "--generator_options", json.dumps(generator_options),
                 "--probes", session.probe
             ]
         else:
@@ -340,6 +1106,8 @@ async def run_scan(session: ScanSession):
         # Update final status
         final_status = "completed" if process.returncode == 0 else "failed"
         final_output = "\n".join(output_lines)
+        results = parse_garak_results(final_output)
+        completed_at = datetime.utcnow()
         
         await db.scan_sessions.update_one(
             {"id": session.id},
@@ -347,11 +1115,18 @@ async def run_scan(session: ScanSession):
                 "$set": {
                     "status": final_status,
                     "output": final_output,
-                    "completed_at": datetime.utcnow()
+                    "results": results,
+                    "completed_at": completed_at
                 }
             }
         )
         
+        # Keep analytics rollups current without failing the scan
+        try:
+            await update_analytics(session, results, completed_at)
+        except Exception as e:
+            logger.error(f"Error updating analytics: {e}")
+        
         # Send completion status
         await manager.send_personal_message(
             json.dumps({
@@ -383,6 +1158,10 @@ async def run_scan(session: ScanSession):
             }),
             session.id
         )
+    finally:
+        if endpoint is not None:
+            ollama_pool.release(endpoint)
+        scan_scheduler.release(session.client_id)
 
 # WebSocket endpoint for real-time updates
 @app.websocket("/ws/terminal/{session_id}")
@@ -414,6 +1193,15 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+@app.on_event("startup")
+async def start_ollama_health_checks():
+    asyncio.create_task(ollama_health_loop())
+
+@app.on_event("startup")
+async def create_indexes():
+    await create_analytics_indexes(db.analytics_rollups, db.analytics_trends)
+    await db.scan_sessions.create_index([("created_at", 1)])
+
 @app.on_event("shutdown")
 async def shutdown_db_client():
     client.close()
@@ -6,15 +6,78 @@ Tests all the new AI WebUI endpoints that were implemented.
 
 import requests
 import json
+import os
 import time
 import asyncio
 import websockets
 import sys
+import threading
 from datetime import datetime
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from pathlib import Path
 
 # Get backend URL from frontend env
 BACKEND_URL = "https://67505abf-582c-44c9-95d6-d142dcdf6d47.preview.emergentagent.com/api"
 
+def start_fake_ollama(models, resident):
+    """Serve /api/tags and /api/ps like an Ollama instance on a free local port"""
+    payloads = {
+        "/api/tags": {"models": [
+            {"name": name, "size": 4700000000, "digest": "0123456789abcdef", "modified_at": "2 days ago"}
+            for name in models
+        ]},
+        "/api/ps": {"models": [{"name": name} for name in resident]}
+    }
+
+    class FakeOllamaHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path not in payloads:
+                self.send_response(404)
+                self.end_headers()
+                return
+            body = json.dumps(payloads[self.path]).encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = HTTPServer(("127.0.0.1", 0), FakeOllamaHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+# Captured from garak 0.12 runs; the first result line keeps garak's ANSI colours
+GARAK_SUMMARY = """garak LLM vulnerability scanner v0.12.0 ( https://github.com/NVIDIA/garak )
+📜 reporting to garak_runs/garak.report.jsonl
+dan.Dan_11_0                                                  dan.DAN: \x1b[1m\x1b[91mFAIL\x1b[0m  ok on    3/   5   (failure rate:  40.00%)
+dan.Dan_11_0                                      mitigation.MitigationBypass: PASS  ok on    5/   5
+test.Test                                                 always.Pass: PASS  ok on    0/   0
+📜 report closed :) garak_runs/garak.report.jsonl
+"""
+
+class RecordingCollection:
+    """Stands in for a Motor collection and keeps the bulk writes it receives"""
+    def __init__(self):
+        self.ops = []
+
+    async def bulk_write(self, ops, ordered=True):
+        self.ops.extend(ops)
+
+class RecordingDatabase:
+    def __init__(self):
+        self.collections = {}
+
+    def __getattr__(self, name):
+        return self.collections.setdefault(name, RecordingCollection())
+
+async def collect_chunks(chunks):
+    return [chunk async for chunk in chunks]
+
+async def collect_items(items):
+    return [item async for item in items]
+
 class AIWebUITester:
     def __init__(self):
         self.base_url = BACKEND_URL
@@ -103,6 +166,399 @@ class AIWebUITester:
             self.log_test("GET /api/environments", False, f"Request error: {str(e)}")
             return False
     
+    def test_get_ollama_endpoints(self):
+        """Test GET /api/ollama/endpoints endpoint"""
+        try:
+            response = self.session.get(f"{self.base_url}/ollama/endpoints")
+            if response.status_code == 200:
+                data = response.json()
+                endpoints = data.get("endpoints")
+                if isinstance(endpoints, list) and len(endpoints) > 0:
+                    required_fields = ["host", "healthy", "in_flight", "models"]
+                    missing_fields = [field for field in required_fields if field not in endpoints[0]]
+                    if not missing_fields:
+                        self.log_test("GET /api/ollama/endpoints", True, f"Retrieved {len(endpoints)} Ollama endpoints", data)
+                        return True
+                    else:
+                        self.log_test("GET /api/ollama/endpoints", False, f"Missing fields: {missing_fields}", data)
+                        return False
+                else:
+                    self.log_test("GET /api/ollama/endpoints", False, "Endpoints field is empty or not a list", data)
+                    return False
+            else:
+                self.log_test("GET /api/ollama/endpoints", False, f"HTTP {response.status_code}", response.text)
+                return False
+        except Exception as e:
+            self.log_test("GET /api/ollama/endpoints", False, f"Request error: {str(e)}")
+            return False
+    
+    def test_get_analytics(self):
+        """Test GET /api/analytics endpoint"""
+        try:
+            response = self.session.get(f"{self.base_url}/analytics")
+            if response.status_code == 200:
+                data = response.json()
+                if isinstance(data.get("rollups"), list) and isinstance(data.get("trends"), list):
+                    self.log_test("GET /api/analytics", True, f"Retrieved {len(data['rollups'])} rollups and {len(data['trends'])} trend points", data)
+                    return True
+                else:
+                    self.log_test("GET /api/analytics", False, "Missing 'rollups' or 'trends' list in response", data)
+                    return False
+            else:
+                self.log_test("GET /api/analytics", False, f"HTTP {response.status_code}", response.text)
+                return False
+        except Exception as e:
+            self.log_test("GET /api/analytics", False, f"Request error: {str(e)}")
+            return False
+    
+    def test_export_sessions(self):
+        """Test GET /api/export/sessions endpoint"""
+        try:
+            response = self.session.get(f"{self.base_url}/export/sessions", params={"format": "ndjson"}, stream=True)
+            if response.status_code == 200:
+                lines = [json.loads(line) for line in response.iter_lines() if line]
+                if all("id" in line and "status" in line for line in lines):
+                    self.log_test("GET /api/export/sessions", True, f"Streamed {len(lines)} sessions as NDJSON")
+                    return True
+                else:
+                    self.log_test("GET /api/export/sessions", False, "Exported rows missing 'id' or 'status'", lines[:5])
+                    return False
+            else:
+                self.log_test("GET /api/export/sessions", False, f"HTTP {response.status_code}", response.text)
+                return False
+        except Exception as e:
+            self.log_test("GET /api/export/sessions", False, f"Request error: {str(e)}")
+            return False
+    
+    def test_get_client_usage(self):
+        """Test GET /api/admin/clients endpoint"""
+        try:
+            admin_key = os.environ.get("ADMIN_API_KEY")
+            headers = {"X-Admin-Key": admin_key} if admin_key else {}
+            response = self.session.get(f"{self.base_url}/admin/clients", headers=headers)
+            if response.status_code == 403 and not admin_key:
+                self.log_test("GET /api/admin/clients", True, "Admin API disabled without ADMIN_API_KEY")
+                return True
+            if response.status_code == 200:
+                data = response.json()
+                if "capacity" in data and isinstance(data.get("clients"), list):
+                    self.log_test("GET /api/admin/clients", True, f"Retrieved usage for {len(data['clients'])} clients", data)
+                    return True
+                else:
+                    self.log_test("GET /api/admin/clients", False, "Missing 'capacity' or 'clients' in response", data)
+                    return False
+            else:
+                self.log_test("GET /api/admin/clients", False, f"HTTP {response.status_code}", response.text)
+                return False
+        except Exception as e:
+            self.log_test("GET /api/admin/clients", False, f"Request error: {str(e)}")
+            return False
+    
+    def test_ollama_pool_routing(self):
+        """Test OllamaPool routing against local fake Ollama servers"""
+        servers = []
+        try:
+            sys.path.insert(0, str(Path(__file__).parent / "backend"))
+            from server import OllamaPool
+
+            servers = [
+                start_fake_ollama(["llama3:latest"], ["llama3:latest"]),
+                start_fake_ollama(["llama3:latest", "phi3:latest"], [])
+            ]
+            hosts = [f"127.0.0.1:{server.server_address[1]}" for server in servers]
+            pool = OllamaPool(hosts + ["127.0.0.1:1"], timeout=1)
+            asyncio.run(pool.refresh())
+            busy, idle, dead = pool.endpoints
+
+            failures = []
+            if dead.healthy:
+                failures.append("unreachable endpoint reported healthy")
+
+            inventory = {model["name"]: model["endpoints"] for model in pool.inventory()}
+            if inventory != {"llama3:latest": [busy.host, idle.host], "phi3:latest": [idle.host]}:
+                failures.append(f"unexpected merged inventory: {inventory}")
+
+            busy.in_flight = 2
+            idle.in_flight = 1
+            chosen = pool.acquire("llama3")
+            if chosen is not idle:
+                failures.append(f"llama3 routed to {chosen.host}, expected least-loaded {idle.host}")
+            pool.release(chosen)
+
+            idle.in_flight = 2
+            chosen = pool.acquire("llama3")
+            if chosen is not busy:
+                failures.append("tie on load should prefer the endpoint with the model resident")
+            pool.release(chosen)
+
+            if pool.acquire("phi3") is not idle:
+                failures.append("phi3 routed to an endpoint without the model")
+
+            try:
+                pool.acquire("mistral")
+                failures.append("model served nowhere did not raise")
+            except RuntimeError:
+                pass
+
+            if not failures:
+                self.log_test("OllamaPool routing", True, "Least-loaded routing and merged inventory correct")
+                return True
+            self.log_test("OllamaPool routing", False, "; ".join(failures))
+            return False
+        except Exception as e:
+            self.log_test("OllamaPool routing", False, f"Error: {str(e)}")
+            return False
+        finally:
+            for server in servers:
+                server.shutdown()
+    
+    def test_scan_admission_local(self):
+        """Test rate and queue rejections, usage counters and client identity locally"""
+        try:
+            sys.path.insert(0, str(Path(__file__).parent / "backend"))
+            from types import SimpleNamespace
+            import server
+            from server import ClientQuota, QuotaExceeded, ScanScheduler
+
+            async def scenario():
+                scheduler = ScanScheduler(
+                    capacity=1, max_queued=3, max_clients=3,
+                    default_quota=ClientQuota(max_concurrent=1, max_queued=5, rate_per_minute=2),
+                    quotas={}, retry_after=30
+                )
+                rejections = []
+                for client_id in ["a", "a", "a", "b", "b", "c"]:
+                    try:
+                        scheduler.admit(client_id)
+                    except QuotaExceeded as e:
+                        rejections.append((client_id, str(e), e.retry_after))
+                return scheduler, rejections
+
+            scheduler, rejections = asyncio.run(scenario())
+            failures = []
+            # "a" runs out of tokens (2 per minute), then "b" fills the global queue and "c" is refused
+            if [(client_id, retry_after > 0) for client_id, _, retry_after in rejections] != [("a", True), ("c", True)]:
+                failures.append(f"unexpected rejections: {rejections}")
+            if not 25 <= rejections[0][2] <= 30:
+                failures.append(f"rate Retry-After should be about one token refill, got {rejections[0][2]}")
+
+            counters = {entry["client_id"]: (entry["submitted"], entry["rejected"]) for entry in scheduler.report()}
+            if counters != {"a": (2, 1), "b": (2, 0), "c": (0, 1)}:
+                failures.append(f"unexpected usage counters: {counters}")
+
+            # Counters outlive pruned scheduling state but stay an LRU capped at max_clients
+            if "c" in scheduler.clients:
+                failures.append("client refused by the global queue limit got scheduling state")
+            for index in range(5):
+                scheduler.client_stats(f"extra-{index}")
+            if list(scheduler.stats) != ["extra-2", "extra-3", "extra-4"]:
+                failures.append(f"stats not evicted least recently seen first: {list(scheduler.stats)}")
+
+            request = SimpleNamespace(
+                headers={"X-Client-Id": "spoofed", "X-Forwarded-For": "6.6.6.6, 203.0.113.7"},
+                client=SimpleNamespace(host="10.0.0.2")
+            )
+            trusted_proxies = server.SCAN_TRUSTED_PROXIES
+            try:
+                server.SCAN_TRUSTED_PROXIES = 0
+                if server.identify_client(request) != "10.0.0.2":
+                    failures.append("client headers honored without being trusted")
+                server.SCAN_TRUSTED_PROXIES = 1
+                if server.identify_client(request) != "203.0.113.7":
+                    failures.append("X-Forwarded-For not resolved to the proxy-appended address")
+            finally:
+                server.SCAN_TRUSTED_PROXIES = trusted_proxies
+
+            if not failures:
+                self.log_test("Scan admission control", True, "Rate/queue 429 paths, counters and identity correct")
+                return True
+            self.log_test("Scan admission control", False, "; ".join(failures))
+            return False
+        except Exception as e:
+            self.log_test("Scan admission control", False, f"Error: {str(e)}")
+            return False
+    
+    def test_scan_scheduler_fair_share(self):
+        """Test ScanScheduler weighted fair ordering and queue limits locally"""
+        try:
+            sys.path.insert(0, str(Path(__file__).parent / "backend"))
+            from server import ClientQuota, QuotaExceeded, ScanScheduler
+
+            async def scenario():
+                quota = ClientQuota(max_concurrent=1, max_queued=20, rate_per_minute=100)
+                scheduler = ScanScheduler(
+                    capacity=1, max_queued=50, max_clients=10, default_quota=quota,
+                    quotas={"heavy": ClientQuota(**{**quota.dict(), "weight": 2})}, retry_after=30
+                )
+                order = []
+
+                async def scan(client_id, ticket):
+                    await ticket
+                    order.append(client_id)
+                    await asyncio.sleep(0)
+                    scheduler.release(client_id)
+
+                blocker = scheduler.admit("blocker")
+                tasks = [asyncio.create_task(scan(client_id, scheduler.admit(client_id)))
+                         for client_id in ["light"] * 6 + ["heavy"] * 6]
+                scheduler.release("blocker")
+                await blocker
+                await asyncio.gather(*tasks)
+
+                limited = ScanScheduler(
+                    capacity=1, max_queued=50, max_clients=10,
+                    default_quota=ClientQuota(max_concurrent=1, max_queued=2, rate_per_minute=100),
+                    quotas={}, retry_after=30
+                )
+                rejection = None
+                for _ in range(4):
+                    try:
+                        limited.admit("flood")
+                    except QuotaExceeded as e:
+                        rejection = e
+                return order, rejection
+
+            order, rejection = asyncio.run(scenario())
+            failures = []
+            # Weight 2 should get two slots for every one of weight 1 while both are backlogged
+            if order[:6].count("heavy") != 4:
+                failures.append(f"unexpected fair-share order: {order}")
+            if rejection is None or rejection.retry_after <= 0:
+                failures.append("client over max_queued was not rejected with a retry time")
+
+            if not failures:
+                self.log_test("ScanScheduler fair share", True, f"Slot order {''.join(c[0] for c in order)}, over-quota client rejected")
+                return True
+            self.log_test("ScanScheduler fair share", False, "; ".join(failures))
+            return False
+        except Exception as e:
+            self.log_test("ScanScheduler fair share", False, f"Error: {str(e)}")
+            return False
+    
+    def test_analytics_local(self):
+        """Test garak result parsing, pass rates and rollup aggregation locally"""
+        try:
+            sys.path.insert(0, str(Path(__file__).parent / "backend"))
+            import server
+
+            failures = []
+            results = server.parse_garak_results(GARAK_SUMMARY)
+            expected = [
+                {"probe": "dan.Dan_11_0", "detector": "dan.DAN", "passed": 3, "total": 5},
+                {"probe": "dan.Dan_11_0", "detector": "mitigation.MitigationBypass", "passed": 5, "total": 5},
+                {"probe": "test.Test", "detector": "always.Pass", "passed": 0, "total": 0}
+            ]
+            if results != expected:
+                failures.append(f"unexpected parsed results: {results}")
+
+            rates = [record["pass_rate"] for record in server._with_pass_rate([dict(r) for r in results])]
+            if rates != [0.6, 1.0, None]:
+                failures.append(f"unexpected pass rates: {rates}")
+
+            rows = [
+                {"session_id": "s1", "model_name": "llama3", "completed_at": datetime(2026, 1, 1, 9), **expected[0]},
+                {"session_id": "s2", "model_name": "llama3", "completed_at": datetime(2026, 1, 1, 17), **expected[0]},
+                {"session_id": "s3", "model_name": "llama3", "completed_at": datetime(2026, 1, 2, 9), **expected[0]}
+            ]
+            rollups, trends = server.aggregate_result_rows(rows)
+            if [(r["passed"], r["total"], r["scans"]) for r in rollups] != [(9, 15, 3)]:
+                failures.append(f"unexpected rollups: {rollups}")
+            if [(t["day"], t["passed"], t["scans"]) for t in trends] != [("2026-01-01", 6, 2), ("2026-01-02", 3, 1)]:
+                failures.append(f"unexpected trends: {trends}")
+
+            live_db = server.db
+            server.db = RecordingDatabase()
+            try:
+                session = server.ScanSession(model_name="llama3", environment="garak", tool="garak", probe="dan")
+                server.analytics_backfill_cutoff = datetime(2026, 1, 1)
+                asyncio.run(server.update_analytics(session, results, datetime(2026, 1, 3, 12)))
+                rollup_ops = server.db.analytics_rollups.ops
+                increments = [op._doc["$inc"] for op in rollup_ops]
+                if increments != [{"passed": r["passed"], "total": r["total"], "scans": 1} for r in expected]:
+                    failures.append(f"unexpected rollup increments: {increments}")
+                if [op._filter["day"] for op in server.db.analytics_trends.ops] != ["2026-01-03"] * 3:
+                    failures.append("trend updates not keyed by completion day")
+                if len(server.db.analytics_rollups_staging.ops) != 3:
+                    failures.append("scan finishing during a backfill not mirrored to staging")
+            finally:
+                server.db = live_db
+                server.analytics_backfill_cutoff = None
+
+            if not failures:
+                self.log_test("Analytics parsing and rollups", True, "Parsing, pass rates and aggregation correct")
+                return True
+            self.log_test("Analytics parsing and rollups", False, "; ".join(failures))
+            return False
+        except Exception as e:
+            self.log_test("Analytics parsing and rollups", False, f"Error: {str(e)}")
+            return False
+    
+    def test_export_encoding_local(self):
+        """Test export serialization, gzip and result filtering locally"""
+        try:
+            sys.path.insert(0, str(Path(__file__).parent / "backend"))
+            import csv
+            import gzip
+            import io
+            import server
+
+            async def iterate(items):
+                for item in items:
+                    yield item
+
+            failures = []
+            sessions = [
+                {"id": "s1", "model_name": "llama3", "probe": "dan", "status": "completed",
+                 "created_at": datetime(2026, 1, 1), "output": 'line, with comma\n"quoted"',
+                 "results": [
+                     {"probe": "dan.Dan_11_0", "detector": "dan.DAN", "passed": 3, "total": 5},
+                     {"probe": "test.Test", "detector": "always.Pass", "passed": 1, "total": 1}
+                 ]},
+                # Finished before results were stored, so rows come from the raw output
+                {"id": "s2", "model_name": "phi3", "probe": "dan", "status": "completed",
+                 "created_at": datetime(2026, 1, 2), "output": GARAK_SUMMARY}
+            ]
+            fields = ["id", "created_at", "output"]
+
+            body = b"".join(asyncio.run(collect_chunks(server._encode_rows(iterate(sessions), fields, "csv")))).decode()
+            rows = list(csv.DictReader(io.StringIO(body)))
+            if [row["output"] for row in rows] != [session["output"] for session in sessions]:
+                failures.append("CSV quoting did not round-trip multi-line output")
+            if rows[0]["created_at"] != "2026-01-01T00:00:00":
+                failures.append(f"datetime not exported as ISO 8601: {rows[0]['created_at']}")
+
+            compressed = b"".join(asyncio.run(collect_chunks(server._gzip_chunks(
+                server._encode_rows(iterate(sessions), fields, "ndjson")
+            ))))
+            lines = [json.loads(line) for line in gzip.decompress(compressed).decode().splitlines()]
+            if [line["id"] for line in lines] != ["s1", "s2"] or lines[0]["output"] != sessions[0]["output"]:
+                failures.append(f"gzip NDJSON did not round-trip: {lines}")
+
+            many = [{"id": i, "created_at": None, "output": "x" * 100} for i in range(2000)]
+            chunks = asyncio.run(collect_chunks(server._encode_rows(iterate(many), fields, "ndjson")))
+            if len(chunks) > 5 or any(len(chunk) < server.EXPORT_CHUNK_SIZE for chunk in chunks[:-1]):
+                failures.append(f"rows not buffered into ~64 KiB chunks: {[len(c) for c in chunks]}")
+
+            results = asyncio.run(collect_items(server._result_rows(iterate(sessions), "dan.Dan_11_0")))
+            if [(r["session_id"], r["detector"]) for r in results] != [
+                ("s1", "dan.DAN"), ("s2", "dan.DAN"), ("s2", "mitigation.MitigationBypass")
+            ]:
+                failures.append(f"probe filter or output fallback wrong: {results}")
+
+            query = server._export_query("llama3", "dan", datetime(2026, 1, 1), datetime(2026, 2, 1))
+            if query != {"model_name": "llama3", "probe": "dan",
+                         "created_at": {"$gte": datetime(2026, 1, 1), "$lt": datetime(2026, 2, 1)}}:
+                failures.append(f"unexpected export query: {query}")
+
+            if not failures:
+                self.log_test("Export encoding", True, "CSV, gzip NDJSON, chunking and result filters correct")
+                return True
+            self.log_test("Export encoding", False, "; ".join(failures))
+            return False
+        except Exception as e:
+            self.log_test("Export encoding", False, f"Error: {str(e)}")
+            return False
+    
     def test_get_garak_probes(self):
         """Test GET /api/garak/probes endpoint"""
         try:
@@ -153,7 +609,7 @@ class AIWebUITester:
                 data = response.json()
                 if "session_id" in data and "status" in data:
                     session_id = data["session_id"]
-                    if data["status"] == "started":
+                    if data["status"] in ["started", "queued"]:
                         self.log_test("POST /api/scan/start", True, f"Scan started with session_id: {session_id}", data)
                         return session_id
                     else:
@@ -254,6 +710,12 @@ class AIWebUITester:
         # Test 3: GET /api/environments
         self.test_get_environments()
         
+        # Test 3b: GET /api/ollama/endpoints
+        self.test_get_ollama_endpoints()
+        
+        # Test 3c: OllamaPool routing against fake Ollama servers
+        self.test_ollama_pool_routing()
+        
         # Test 4: GET /api/garak/probes
         self.test_get_garak_probes()
         
@@ -272,6 +734,21 @@ class AIWebUITester:
             self.log_test("GET /api/scan/{session_id}", False, "Skipped due to failed scan start")
             self.log_test("WebSocket /ws/terminal/{session_id}", False, "Skipped due to failed scan start")
         
+        # Test 8: GET /api/analytics
+        self.test_analytics_local()
+        self.test_get_analytics()
+        
+        # Test 9: GET /api/export/sessions
+        self.test_export_encoding_local()
+        self.test_export_sessions()
+        
+        # Test 10: GET /api/admin/clients
+        self.test_get_client_usage()
+        
+        # Test 11: admission control and fair-share scheduling
+        self.test_scan_scheduler_fair_share()
+        self.test_scan_admission_local()
+        
         # Print summary
         print("\n" + "=" * 60)
         print("TEST SUMMARY")